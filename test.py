@@ -1,14 +1,24 @@
 import ollama
+import atexit
 import os
 import json
+import hashlib
+import importlib.util
+import multiprocessing
 import re
-from datetime import datetime
-from openpyxl import Workbook, load_workbook
-from collections import defaultdict
+import sys
+import threading
+from dataclasses import dataclass, field
+from datetime import date, datetime
+from collections import defaultdict, deque
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import chromadb
+import requests
+from requests.adapters import HTTPAdapter
 from langchain_community.document_loaders import PyPDFLoader
 from langchain_ollama import OllamaEmbeddings
 from langchain_chroma import Chroma
-from langchain.docstore.document import Document
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 
 # ------------------ 教材來源 ------------------
@@ -19,179 +29,585 @@ PDF_LIST = [
     "Computer Organization and Design.pdf"
 ]
 
+# 預先建立「教材名稱（小寫）→ 檔名」對照與比對用的正規表示式，查詢時只需掃描一次提問
+PDF_BASENAMES = {os.path.splitext(os.path.basename(f))[0].lower(): f for f in PDF_LIST}
+# 沒有教材時不建立正規表示式，否則空字串樣式會比對到任何提問
+PDF_REGEX = re.compile("|".join(map(re.escape, PDF_BASENAMES))) if PDF_BASENAMES else None
+
 # 儲存向量資料庫的目錄與教材紀錄清單
 DB_DIR = "./db"
 DB_INFO_FILE = os.path.join(DB_DIR, "dbinfo.json")
 
+# ------------------ 批次嵌入 ------------------
+
+# Ollama 服務位址與嵌入模型設定；與 ollama.chat 相同，可用環境變數 OLLAMA_HOST 指定（可省略 http://）
+OLLAMA_URL = os.environ.get("OLLAMA_HOST", "http://localhost:11434")
+if "://" not in OLLAMA_URL:
+    OLLAMA_URL = f"http://{OLLAMA_URL}"
+EMBED_MODEL = "nomic-embed-text"
+EMBED_BATCH_SIZE = 128
+EMBED_TIMEOUT = 60
+EMBED_WORKERS = int(os.environ.get("EMBED_WORKERS", "4"))
+
+# 共用連線池，連線數與並行批次數一致，避免每個批次重新建立 HTTP 連線
+_embed_session = requests.Session()
+_embed_adapter = HTTPAdapter(pool_connections=1, pool_maxsize=EMBED_WORKERS)
+_embed_session.mount("http://", _embed_adapter)
+_embed_session.mount("https://", _embed_adapter)
+
+# 將一批文字送到 /api/embed 取得向量
+def _post_embed(base_url, model, batch):
+    resp = _embed_session.post(
+        f"{base_url.rstrip('/')}/api/embed",
+        json={"model": model, "input": batch},
+        timeout=EMBED_TIMEOUT,
+    )
+    resp.raise_for_status()
+    return resp.json()["embeddings"]
+
+# 建庫用的單一批次，失敗時回傳 None，讓其他批次仍能跑完
+def _embed_one_batch(base_url, model, batch):
+    try:
+        return _post_embed(base_url, model, batch)
+    except Exception as e:
+        print(f"⚠️ 嵌入批次失敗：{e}")
+        return None
+
+# 改用 /api/embed 一次送出多段文字，並同時送出多個批次讓 GPU 不閒置
+class BatchOllamaEmbeddings(OllamaEmbeddings):
+    # 有指定 base_url 時優先使用，否則與 ollama.chat 一樣走 OLLAMA_HOST
+    def _ollama_url(self):
+        return self.base_url or OLLAMA_URL
+
+    def embed_documents(self, texts):
+        base_url = self._ollama_url()
+        batches = [texts[i:i + EMBED_BATCH_SIZE] for i in range(0, len(texts), EMBED_BATCH_SIZE)]
+        with ThreadPoolExecutor(max_workers=EMBED_WORKERS) as ex:
+            results = list(ex.map(lambda batch: _embed_one_batch(base_url, self.model, batch), batches))
+        # 有批次失敗時整本教材都不寫入，避免把零向量或缺漏的段落存進資料庫
+        failed = sum(batch_vecs is None for batch_vecs in results)
+        if failed:
+            raise RuntimeError(f"{failed}/{len(batches)} 個嵌入批次失敗")
+        return [vec for batch_vecs in results for vec in batch_vecs]
+
+    # 查詢向量先正規化再查快取，重複的提問不必再呼叫 Ollama
+    def embed_query(self, text):
+        return list(_cached_query_embedding(self._ollama_url(), self.model, text.strip().lower()))
+
+@lru_cache(maxsize=512)
+def _cached_query_embedding(base_url, model, text):
+    return tuple(_post_embed(base_url, model, [text])[0])  # 失敗時直接拋出，避免把零向量留在快取中
+
 # ------------------ 檢查是否有新教材 ------------------
 
-# 取得上次已載入的教材檔名清單
-def get_loaded_pdf_list():
+# 取得上次已載入的教材與其 SHA-256 雜湊
+def get_loaded_pdf_hashes():
     if os.path.exists(DB_INFO_FILE):
         with open(DB_INFO_FILE, "r", encoding="utf-8") as f:
-            return json.load(f)
-    return []
-
-# 儲存目前教材檔名清單
-def save_loaded_pdf_list(pdf_list):
+            info = json.load(f)
+        # 舊版只存檔名清單，雜湊未知，視為需要重新嵌入
+        if isinstance(info, list):
+            return {pdf_file: None for pdf_file in info}
+        return info
+    return {}
+
+# 儲存目前教材與其雜湊
+def save_loaded_pdf_hashes(pdf_hashes):
     os.makedirs(DB_DIR, exist_ok=True)
     with open(DB_INFO_FILE, "w", encoding="utf-8") as f:
-        json.dump(pdf_list, f, ensure_ascii=False, indent=2)
+        json.dump(pdf_hashes, f, ensure_ascii=False, indent=2)
+
+# 計算教材檔案的 SHA-256，用來判斷內容是否變動
+def file_sha256(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
 
 # ------------------ 自訂章節切割函式 + 分段 ------------------
 
+# 章節標題（Chapter X）的比對規則，於載入時編譯一次
+CHAPTER_RE = re.compile(r'^[ \t]*chapter\s+\d+', re.IGNORECASE | re.MULTILINE)
+
 # 依章節名稱（Chapter X）分章，並使用文字切割器細分內容以適合模型處理
+# documents 應來自同一本教材；各頁先串接成全文，再以一次正規表示式掃描找出章節起點
 def split_by_chapter_and_chunk(documents, chunk_size=1000, chunk_overlap=100):
     splitter = RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
-    chapters = []
-    current_chapter = []
-    current_title = ""
-    for doc in documents:
-        text = doc.page_content
-        lines = text.splitlines()
-        for line in lines:
-            if re.match(r'^\s*(Chapter|CHAPTER)\s+\d+', line):
-                if current_chapter:
-                    content = "\n".join(current_chapter)
-                    chunks = splitter.split_text(content)
-                    for chunk in chunks:
-                        chapters.append(Document(page_content=chunk, metadata={"chapter": current_title}))
-                    current_chapter = []
-                current_title = line.strip()
-            current_chapter.append(line.strip())
-    if current_chapter:
-        content = "\n".join(current_chapter)
-        chunks = splitter.split_text(content)
-        for chunk in chunks:
-            chapters.append(Document(page_content=chunk, metadata={"chapter": current_title}))
-    return chapters
+    if not documents:
+        return []
+    source = documents[0].metadata.get("source_file")
+    full = "\n".join(doc.page_content for doc in documents)
+
+    boundaries = [m.start() for m in CHAPTER_RE.finditer(full)]
+    if not boundaries or boundaries[0] != 0:
+        boundaries.insert(0, 0)  # 第一個章節標題之前的內容自成一段
+    boundaries.append(len(full))
+
+    texts = []
+    metadatas = []
+    for start, end in zip(boundaries, boundaries[1:]):
+        chapter_text = full[start:end]
+        title = ""
+        if CHAPTER_RE.match(chapter_text):
+            title = chapter_text.split("\n", 1)[0].strip()
+        texts.append(chapter_text)
+        metadatas.append({"chapter": title, "source_file": source})
+
+    # 一次交給切割器產生所有段落與對應的 metadata
+    return splitter.create_documents(texts, metadatas=metadatas)
 
 # ------------------ 建立知識庫 ------------------
 
-# 如果教材清單與上次不一致就需要重建資料庫
-need_refresh = sorted(PDF_LIST) != sorted(get_loaded_pdf_list())
-
-if need_refresh:
-    print("🧠 偵測到有新教材變動，開始重新建立向量資料庫...")
-    documents = []
-
+# 在子行程中解析單一 PDF，並標記每段資料的教材來源
+def _load_pdf(pdf_file):
+    loaded_docs = PyPDFLoader(pdf_file).load()
+    for doc in loaded_docs:
+        doc.metadata["source_file"] = pdf_file
+    return loaded_docs
+
+# 各教材互不相關，多本時以多個行程同時解析
+# 此時 Chroma client 已開啟並有背景執行緒，fork 多執行緒的行程可能死結，因此各平台一律以 spawn 啟動子行程
+def load_pdfs(pdf_files):
+    if len(pdf_files) <= 1:
+        return [_load_pdf(f) for f in pdf_files]
+    with ProcessPoolExecutor(
+        max_workers=min(len(pdf_files), os.cpu_count() or 1),
+        mp_context=multiprocessing.get_context("spawn"),
+    ) as ex:
+        return list(ex.map(_load_pdf, pdf_files))
+
+# 逐檔比對雜湊，只嵌入新增或變動的教材，並移除已不在清單中的教材
+def sync_vectordb(vectordb):
+    loaded_hashes = get_loaded_pdf_hashes()
+    current_hashes = {}
     for pdf_file in PDF_LIST:
         if os.path.exists(pdf_file):
-            print(f"📘 載入教材：{pdf_file}")
-            loader = PyPDFLoader(pdf_file)
-            loaded_docs = loader.load()
-            for doc in loaded_docs:
-                doc.metadata["source_file"] = pdf_file  # 標記每段資料的教材來源
-            documents.extend(loaded_docs)
+            current_hashes[pdf_file] = file_sha256(pdf_file)
         else:
             print(f"⚠️ 找不到教材：{pdf_file}")
+            if loaded_hashes.get(pdf_file) is not None:
+                current_hashes[pdf_file] = loaded_hashes[pdf_file]  # 暫時找不到的檔案保留原有資料
+
+    removed_pdfs = [f for f in loaded_hashes if f not in current_hashes]
+    changed_pdfs = [f for f, h in current_hashes.items() if loaded_hashes.get(f) != h]
+
+    if not removed_pdfs and not changed_pdfs:
+        print("✅ 教材未變動，直接載入資料庫")
+        return
+
+    print("🧠 偵測到有新教材變動，開始更新向量資料庫...")
+
+    for pdf_file in removed_pdfs:
+        print(f"🗑️ 移除教材：{pdf_file}")
+        vectordb._collection.delete(where={"source_file": pdf_file})
+
+    for pdf_file in changed_pdfs:
+        print(f"📘 載入教材：{pdf_file}")
+    all_loaded = load_pdfs(changed_pdfs)
+
+    for pdf_file, loaded_docs in zip(changed_pdfs, all_loaded):
+        # 先清掉舊版內容，避免重複的段落
+        vectordb._collection.delete(where={"source_file": pdf_file})
+
+        # 使用章節分段與文字切割進行內容拆解
+        docs = split_by_chapter_and_chunk(loaded_docs)
+        print(f"✅ {pdf_file} 已依章節分段為 {len(docs)} 筆")
+        if docs:
+            try:
+                vectordb.add_documents(docs)
+            except Exception as e:
+                # 不記錄此教材的雜湊，下次啟動時會重新嵌入
+                print(f"⚠️ {pdf_file} 嵌入失敗，下次啟動時重試：{e}")
+                current_hashes.pop(pdf_file)
+
+    save_loaded_pdf_hashes(current_hashes)
+
+# 以 MMR 先取回 20 筆候選，再挑出彼此差異較大的 3 筆，避免送進模型的段落內容重複
+RETRIEVE_K = 3
+SEARCH_TYPE = "mmr"
+SEARCH_KWARGS = {"k": RETRIEVE_K, "fetch_k": 20, "lambda_mult": 0.5}
+
+# 設定 RERANK=1 時改為取回相似度最高的 20 筆，再由 CPU 上的 cross-encoder 重新評分挑出 3 筆
+# 每次查詢約多花 0.2 秒，需另外安裝 sentence-transformers，預設關閉
+RERANK = os.environ.get("RERANK", "0") == "1"
+RERANK_MODEL = "cross-encoder/ms-marco-MiniLM-L-6-v2"
+RERANK_CANDIDATES = 20
+if RERANK and importlib.util.find_spec("sentence_transformers") is None:
+    print("⚠️ 未安裝 sentence-transformers，已停用重排序（pip install sentence-transformers 後再設定 RERANK=1）")
+    RERANK = False
+if RERANK:
+    SEARCH_TYPE = "similarity"
+    SEARCH_KWARGS = {"k": RERANK_CANDIDATES}
+
+# cross-encoder 只在第一次使用時載入，之後共用同一個模型；載入失敗時不再重試
+_reranker = None
+_reranker_failed = False
+
+def get_reranker():
+    global _reranker, _reranker_failed
+    if _reranker is None and not _reranker_failed:
+        try:
+            from sentence_transformers import CrossEncoder
+            _reranker = CrossEncoder(RERANK_MODEL, device="cpu")
+        except Exception as e:
+            print(f"⚠️ 重排序模型載入失敗，改用相似度最高的 {RETRIEVE_K} 筆：{e}")
+            _reranker_failed = True
+    return _reranker
+
+def rerank_docs(prompt, docs):
+    if len(docs) <= RETRIEVE_K:
+        return docs
+    reranker = get_reranker()
+    if reranker is None:
+        return docs[:RETRIEVE_K]
+    scores = reranker.predict([(prompt, doc.page_content) for doc in docs])
+    ranked = sorted(zip(scores, docs), key=lambda pair: pair[0], reverse=True)
+    return [doc for _, doc in ranked[:RETRIEVE_K]]
+
+embedding = BatchOllamaEmbeddings(model=EMBED_MODEL)
+
+# nomic-embed-text 以餘弦相似度訓練，向量未正規化，用 L2 距離會被向量長度主導，因此改用 cosine
+# HNSW 參數只在建立 collection 時生效，舊資料庫需以 --reindex 重建一次
+COLLECTION_METADATA = {"hnsw:space": "cosine", "hnsw:M": 32, "hnsw:construction_ef": 200, "hnsw:search_ef": 64}
+REINDEX = "--reindex" in sys.argv
+
+# --export [YYYY-MM-DD]：只把指定日期（預設今天）的對話紀錄轉成 xlsx，不開啟資料庫也不預熱模型
+EXPORT_DATE = None
+if "--export" in sys.argv:
+    _export_args = sys.argv[sys.argv.index("--export") + 1:]
+    if _export_args and not _export_args[0].startswith("--"):
+        EXPORT_DATE = _export_args[0]  # 格式於主程式匯出前檢查
+    else:
+        EXPORT_DATE = date.today().isoformat()
+COLLECTION_NAME = "langchain"  # langchain_chroma 的預設名稱，沿用以讀取既有資料庫
 
-    # 使用章節分段與文字切割進行內容拆解
-    docs = split_by_chapter_and_chunk(documents)
-    print(f"✅ 已依章節分段為 {len(docs)} 筆")
+# 以不帶 metadata 的方式讀取既有 collection 的距離設定；collection 不存在時回傳 None
+def existing_collection_space(client):
+    try:
+        collection = client.get_collection(COLLECTION_NAME)
+    except Exception:
+        return None
+    return (collection.metadata or {}).get("hnsw:space", "l2")
+
+# 只有新建或本來就是 cosine 的 collection 才帶入 COLLECTION_METADATA，避免覆寫或被拒絕變更距離設定
+def open_vectordb(client, space):
+    metadata = COLLECTION_METADATA if space in (None, "cosine") else None
+    return Chroma(
+        client=client,
+        collection_name=COLLECTION_NAME,
+        embedding_function=embedding,
+        collection_metadata=metadata,
+    )
+
+# 解析用的子行程以 spawn 啟動時會重新執行本檔，子行程不可重複開啟資料庫或預熱模型
+IS_MAIN_PROCESS = multiprocessing.parent_process() is None
+
+if IS_MAIN_PROCESS and EXPORT_DATE is None:
+    chroma_client = chromadb.PersistentClient(path=DB_DIR)
+    space = existing_collection_space(chroma_client)
+    # 舊版資料庫的段落沒有 source_file 標記（教材紀錄沒有雜湊），無法逐檔更新，視同 --reindex 整個重建，
+    # 讓唯一一次的重建直接建立在 cosine collection 上
+    legacy_db = any(h is None for h in get_loaded_pdf_hashes().values())
+    if REINDEX or legacy_db:
+        # 刪除舊 collection 並清空教材紀錄，讓所有教材以新的距離設定重新嵌入
+        print("🔄 重建向量資料庫...")
+        if space is not None:
+            chroma_client.delete_collection(COLLECTION_NAME)
+        save_loaded_pdf_hashes({})
+        space = None
+    elif space not in (None, "cosine"):
+        print(f"⚠️ 現有資料庫使用 {space} 距離，請以 --reindex 執行一次以改用 cosine")
+    vectordb = open_vectordb(chroma_client, space)
+    sync_vectordb(vectordb)
+
+    # 建立檢索器供後續問答查詢使用
+    retriever = vectordb.as_retriever(search_type=SEARCH_TYPE, search_kwargs=SEARCH_KWARGS)
+
+# 指定教材時改用 Chroma 的 metadata 過濾，只在該教材的段落中搜尋；依教材快取檢索器
+pdf_retrievers = {}
+_pdf_retrievers_lock = threading.Lock()
+
+def get_pdf_retriever(pdf_file):
+    with _pdf_retrievers_lock:
+        if pdf_file not in pdf_retrievers:
+            pdf_retrievers[pdf_file] = vectordb.as_retriever(
+                search_type=SEARCH_TYPE,
+                search_kwargs={**SEARCH_KWARGS, "filter": {"source_file": pdf_file}},
+            )
+        return pdf_retrievers[pdf_file]
+
+# 檢索結果快取：完全相同的提問（正規化後）直接回傳上次的段落
+RETRIEVAL_CACHE_SIZE = 512
+retrieval_cache = {}
+_retrieval_cache_lock = threading.Lock()  # 只在讀寫快取時持有，檢索本身不佔用鎖
+
+def retrieve_docs(prompt, selected_pdf):
+    key = (prompt.strip().lower(), selected_pdf)
+    with _retrieval_cache_lock:
+        if key in retrieval_cache:
+            return retrieval_cache[key]
+
+    # 執行檢索，若有教材指定則只搜尋該教材的段落
+    if selected_pdf:
+        related_docs = get_pdf_retriever(selected_pdf).invoke(prompt)
+        if not related_docs:
+            related_docs = retriever.invoke(prompt)  # 若無結果則回退
+    else:
+        related_docs = retriever.invoke(prompt)
 
-    # 建立嵌入向量與向量資料庫
-    embedding = OllamaEmbeddings(model="nomic-embed-text")
-    vectordb = Chroma.from_documents(docs, embedding, persist_directory=DB_DIR)
-    save_loaded_pdf_list(PDF_LIST)
-else:
-    print("✅ 教材未變動，直接載入資料庫")
-    embedding = OllamaEmbeddings(model="nomic-embed-text")
-    vectordb = Chroma(persist_directory=DB_DIR, embedding_function=embedding)
+    if RERANK:
+        related_docs = rerank_docs(prompt, related_docs)
 
-# 建立檢索器供後續問答查詢使用
-retriever = vectordb.as_retriever()
+    with _retrieval_cache_lock:
+        if key not in retrieval_cache and len(retrieval_cache) >= RETRIEVAL_CACHE_SIZE:
+            retrieval_cache.pop(next(iter(retrieval_cache)))  # 移除最早加入的項目
+        retrieval_cache[key] = related_docs
+    return related_docs
 
 # ------------------ 儲存對話紀錄 ------------------
 
-# 每次使用者問答都儲存到 Excel（UTF-8）中，避免亂碼與資訊流失
-
-def save_chat_xlsx(user_msg, bot_reply):
-    today_str = datetime.now().strftime("%Y-%m-%d")
-    filename = f"chat_log_{today_str}.xlsx"
-    time_str = datetime.now().strftime("%H:%M:%S")
-
+# 每次使用者問答以一行 JSON 附加到當日紀錄檔（UTF-8），每輪只需寫入一行，避免重寫整個 Excel 檔
+
+def chat_log_path(date_str):
+    return f"chat_log_{date_str}.jsonl"
+
+# 當日紀錄檔保持開啟，跨日時才換檔；程式結束時自動關閉
+_chat_log = {"date": None, "file": None}
+_chat_log_lock = threading.Lock()
+
+def _close_chat_log():
+    if _chat_log["file"] is not None:
+        _chat_log["file"].close()
+        _chat_log["file"] = None
+
+def _close_chat_log_locked():
+    with _chat_log_lock:
+        _close_chat_log()
+
+atexit.register(_close_chat_log_locked)
+
+def _get_chat_log_file(today):
+    if _chat_log["date"] != today:
+        _close_chat_log()
+        _chat_log["file"] = open(chat_log_path(today.isoformat()), "a", encoding="utf-8")
+        _chat_log["date"] = today
+    return _chat_log["file"]
+
+def save_chat_log(user_msg, bot_reply):
+    now = datetime.now()
+    record = {"time": now.strftime("%H:%M:%S"), "user": user_msg, "reply": bot_reply}
+    line = json.dumps(record, ensure_ascii=False) + "\n"
+    with _chat_log_lock:
+        f = _get_chat_log_file(now.date())
+        f.write(line)
+        f.flush()  # 每輪立即寫入，程式中斷時也不會遺失紀錄
+
+# 需要 Excel 時再將指定日期（YYYY-MM-DD）的紀錄轉成 xlsx，命令列用法：python test.py --export 2024-05-01
+def export_to_xlsx(date_str):
+    from openpyxl import Workbook
+
+    log_path = chat_log_path(date_str)
+    if not os.path.exists(log_path):
+        print(f"⚠️ 找不到對話紀錄：{log_path}")
+        return None
+
+    wb = Workbook()
+    ws = wb.active
+    ws.append(["時間", "使用者", "AI 回覆"])
+    with open(log_path, "r", encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                record = json.loads(line)
+                ws.append([record["time"], record["user"], record["reply"]])
+
+    filename = f"chat_log_{date_str}.xlsx"
     try:
-        if os.path.exists(filename):
-            wb = load_workbook(filename)
-            ws = wb.active
-        else:
-            wb = Workbook()
-            ws = wb.active
-            ws.append(["時間", "使用者", "AI 回覆"])
-
-        ws.append([time_str, user_msg, bot_reply])
         wb.save(filename)
     except PermissionError:
         print("⚠️ 檔案可能已開啟中，請關閉 Excel 後重試。")
+        return None
+    return filename
 
 # ------------------ LLM 對話處理 ------------------
 
 # 建立初始提示與模型設定
-messages = [{"role": "system", "content": "你是一位用繁體中文回答的家教老師，請用簡單方式講解問題。"}]
-MODEL_NAME = 'llama3'
-last_user = ""
-last_reply = ""
-
-# 對話主函式
-
-def chat_with_ollama(prompt):
-    global last_user, last_reply
-
-    # 嘗試從提問中自動抓出使用者想指定哪本教材
-    selected_pdf = None
-    for pdf_file in PDF_LIST:
-        base = os.path.splitext(os.path.basename(pdf_file))[0].lower()
-        if base in prompt.lower():
-            selected_pdf = pdf_file
-            break
-
-    # 執行檢索，若有教材指定則過濾對應段落
-    if selected_pdf:
-        print(f"🎯 只搜尋教材：{selected_pdf}")
-        all_docs = retriever.invoke(prompt)
-        related_docs = [doc for doc in all_docs if doc.metadata.get("source_file") == selected_pdf][:3]
-        if not related_docs:
-            related_docs = all_docs[:3]  # 若無結果則回退
-    else:
-        related_docs = retriever.invoke(prompt)[:3]
-
-    # 整理出答案的上下文引用來源與段落
-    context_chunks = []
+SYSTEM_MSG = {"role": "system", "content": "你是一位用繁體中文回答的家教老師，請用簡單方式講解問題。"}
+HISTORY_SIZE = 20
+# 預設使用 Q4_K_M 量化版：VRAM 約為 Q8 的一半、生成速度較快，對家教問答的品質影響很小
+# 顯示卡記憶體充足且重視準確度時，可設定環境變數 MODEL_NAME=llama3:8b-instruct-q8_0 改用 Q8
+MODEL_NAME = os.environ.get("MODEL_NAME", "llama3:8b-instruct-q4_K_M")
+KEEP_ALIVE = "1h"  # 讓模型在使用者閒置時仍常駐 GPU，避免重新載入
+# context window 依實際用量明確指定：歷史只存原始提問與回覆（每則回覆最多 num_predict 個 token），
+# 10 輪約 5.6k token，加上本輪教材內容（CONTEXT_TOKEN_BUDGET）與回覆，8192 足以容納而不必截掉舊訊息
+CHAT_OPTIONS = {"num_ctx": 8192, "num_batch": 512, "num_predict": 512}
+
+# 啟動時先載入嵌入模型與對話模型，讓第一個問題不必等待冷啟動
+def warm_up_models():
+    try:
+        _post_embed(embedding._ollama_url(), EMBED_MODEL, ["warmup"])
+        ollama.chat(
+            model=MODEL_NAME,
+            messages=[{"role": "user", "content": "hi"}],
+            options={**CHAT_OPTIONS, "num_predict": 1},
+            keep_alive=KEEP_ALIVE,
+        )
+    except Exception as e:
+        print(f"⚠️ 模型預熱失敗：{e}")
+
+if IS_MAIN_PROCESS and EXPORT_DATE is None:
+    warm_up_models()
+    if RERANK:
+        get_reranker()  # 與 Ollama 預熱分開，Ollama 無法連線時仍先載入重排序模型
+
+# 上下文長度上限（token 數），以每 3 個字元約 1 個 token 估算，適用於目前的英文教材；
+# 中文約 1 個字就是 1 個 token，改用中文教材時這個估算會低估實際 token 數
+CONTEXT_TOKEN_BUDGET = 1500
+CONTEXT_SEPARATOR = "\n---\n"
+
+# 整理檢索段落：去除重複內容、限制長度，並把引用來源統一放在最後
+def build_context(related_docs):
+    seen = set()
+    unique_docs = []
     for doc in related_docs:
+        h = hash(doc.page_content[:100].strip())
+        if h not in seen:
+            seen.add(h)
+            unique_docs.append(doc)
+
+    # 以整段為單位放入，超過上限就停止；只有第一段就超過時才截斷，避免完全沒有上下文
+    max_chars = CONTEXT_TOKEN_BUDGET * 3
+    kept_docs = []
+    parts = []
+    length = 0
+    for doc in unique_docs:
+        extra = len(doc.page_content) + (len(CONTEXT_SEPARATOR) if parts else 0)
+        if length + extra > max_chars:
+            if not parts:
+                parts.append(doc.page_content[:max_chars])
+                kept_docs.append(doc)
+            break
+        parts.append(doc.page_content)
+        kept_docs.append(doc)
+        length += extra
+    context_text = CONTEXT_SEPARATOR.join(parts)
+
+    # 來源只列出實際放入上下文的段落
+    sources = []
+    for doc in kept_docs:
         source = doc.metadata.get("source_file", "未知教材")
         page = doc.metadata.get("page", "未知頁數")
-        chunk = f"[來自：{source} 第 {page} 頁]\n{doc.page_content}"
-        context_chunks.append(chunk)
-
-    context_text = "\n---\n".join(context_chunks)
-
-    # 包裝 prompt 給模型（含上下文）
-    rag_prompt = f"""以下是教材內容摘要，請根據這些內容來回答問題：\n\n{context_text}\n\n使用者問題：{prompt}\n請用繁體中文詳細解釋，並舉例子說明。"""
-
-    messages.append({"role": "user", "content": rag_prompt})
+        label = f"{source} 第 {page} 頁"
+        if label not in sources:
+            sources.append(label)
+    if sources:
+        context_text += f"\n\n[來自：{'、'.join(sources)}]"
+    return context_text
+
+# 每位使用者各自的對話狀態；共用的快取、對話表與紀錄檔各有鎖保護，
+# 同一位使用者的提問依序處理，不同使用者可在不同執行緒同時對話
+@dataclass
+class Session:
+    history: deque = field(default_factory=lambda: deque(maxlen=HISTORY_SIZE))  # 最近的使用者／助理訊息，超過上限時自動捨棄最舊的
+    last_user: str = ""
+    last_reply: str = ""
+    lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
+
+    # 對話主函式：每產生一段文字就交給 on_token（例如印到終端機或送給網頁），回傳完整回覆；失敗時拋出例外
+    # 從提問中辨識出指定教材時，會先以教材檔名呼叫 on_pdf_selected；本方法不直接輸出任何文字
+    def chat(self, prompt, on_token=None, on_pdf_selected=None):
+        with self.lock:
+            # 嘗試從提問中自動抓出使用者想指定哪本教材
+            m = PDF_REGEX.search(prompt.lower()) if PDF_REGEX else None
+            selected_pdf = PDF_BASENAMES[m.group(0)] if m else None
+
+            if selected_pdf and on_pdf_selected:
+                on_pdf_selected(selected_pdf)
+            related_docs = retrieve_docs(prompt, selected_pdf)
+
+            context_text = build_context(related_docs)
+
+            # 包裝 prompt 給模型（含上下文）
+            rag_prompt = f"""以下是教材內容摘要，請根據這些內容來回答問題：\n\n{context_text}\n\n使用者問題：{prompt}\n請用繁體中文詳細解釋，並舉例子說明。"""
+
+            messages = [SYSTEM_MSG, *self.history, {"role": "user", "content": rag_prompt}]
+
+            # 以串流方式邊產生邊顯示，使用者不必等整段回覆完成
+            stream = ollama.chat(
+                model=MODEL_NAME,
+                messages=messages,
+                stream=True,
+                options=CHAT_OPTIONS,
+                keep_alive=KEEP_ALIVE,
+            )
+            reply_parts = []
+            for chunk in stream:
+                tok = chunk['message']['content']
+                if on_token:
+                    on_token(tok)
+                reply_parts.append(tok)
+            reply = "".join(reply_parts)
+            # 歷史只保留原始提問，教材內容每輪重新檢索，避免舊的上下文佔滿 context window
+            self.history.append({"role": "user", "content": prompt})
+            self.history.append({"role": "assistant", "content": reply})
+
+            # 儲存對話與更新記憶
+            save_chat_log(prompt, reply)
+            self.last_user = prompt
+            self.last_reply = reply
+
+            return reply
+
+# 依使用者 ID 取得各自的對話，沒有時建立新的；命令列模式只使用預設對話
+DEFAULT_SESSION_ID = "default"
+sessions: dict[str, Session] = {}
+_sessions_lock = threading.Lock()
+
+def get_session(user_id=DEFAULT_SESSION_ID):
+    with _sessions_lock:
+        if user_id not in sessions:
+            sessions[user_id] = Session()
+        return sessions[user_id]
+
+# 命令列用：把回覆逐字印到終端機，錯誤時印出並回傳錯誤訊息
+def chat_with_ollama(prompt, user_id=DEFAULT_SESSION_ID):
+    started = False
+
+    def print_token(tok):
+        nonlocal started
+        if not started:
+            print("家教老師：", end="", flush=True)
+            started = True
+        print(tok, end="", flush=True)
+
+    def print_selected_pdf(pdf_file):
+        print(f"🎯 只搜尋教材：{pdf_file}")
 
     try:
-        response = ollama.chat(model=MODEL_NAME, messages=messages)
-        reply = response['message']['content']
-        messages.append({"role": "assistant", "content": reply})
-
-        # 儲存對話與更新記憶
-        save_chat_xlsx(prompt, reply)
-        last_user = prompt
-        last_reply = reply
-
-        # 控制歷史訊息數量，避免過長
-        if len(messages) > 20:
-            messages.pop(1)
-
-        return reply
+        reply = get_session(user_id).chat(prompt, on_token=print_token, on_pdf_selected=print_selected_pdf)
     except Exception as e:
-        return f"❌ 發生錯誤：{e}"
+        reply = f"❌ 發生錯誤：{e}"
+        if started:
+            print()
+        print(reply)
+        return reply
+    print()
+    return reply
 
 # ------------------ 主程式 ------------------
 
 if __name__ == "__main__":
+    if EXPORT_DATE is not None:
+        try:
+            date.fromisoformat(EXPORT_DATE)
+        except ValueError:
+            print(f"⚠️ 日期格式錯誤：{EXPORT_DATE}，請使用 YYYY-MM-DD，例如 --export 2024-05-01")
+            sys.exit(2)
+        filename = export_to_xlsx(EXPORT_DATE)
+        if filename:
+            print(f"📄 已匯出：{filename}")
+        sys.exit(0 if filename else 1)
+
     print("📘 家教系統已啟動，輸入 quit,exit,bye 離開")
 
     while True:
@@ -204,5 +620,4 @@ if __name__ == "__main__":
             print("👋 再見，祝學習愉快！")
             break
 
-        response = chat_with_ollama(user_input)
-        print("家教老師：", response)
+        chat_with_ollama(user_input)